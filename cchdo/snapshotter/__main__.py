@@ -1,23 +1,43 @@
+import argparse
 import asyncio
+import hashlib
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from hashlib import file_digest
+from itertools import groupby
+from operator import attrgetter, itemgetter
 from pathlib import Path
 from collections import defaultdict, Counter
-from zipfile import ZipFile, ZIP_DEFLATED
+import zipfile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 import csv
 from datetime import datetime, timezone
 
+import aiofiles
 import aiohttp
+import orjson
 from rich.progress import Progress
 
 from appdirs import AppDirs
 
+try:
+    from isal import isal_zlib
+
+    # ISA-L's SIMD accelerated DEFLATE is a drop in replacement for zlib and
+    # runs 2-4x faster at the same ratios. zipfile looks its compressor up on
+    # the module's zlib attribute at call time so this swap covers every
+    # archive we write. isal only has levels 0-3, so clamp requested levels.
+    zipfile.zlib = isal_zlib
+    MAX_ZIP_LEVEL = isal_zlib.ISAL_BEST_COMPRESSION
+except ImportError:
+    MAX_ZIP_LEVEL = 9
+
 dirs = AppDirs("snapshotter", "edu.ucsd.cchdo")
 
 CCHDO_API_BASE = "https://cchdo.ucsd.edu"
 
-# Limit how many parallel requests are going
-aiohttp.TCPConnector(limit=20)
-
 file_exts = {
     ("bottle", "cf_netcdf"): "_bottle.nc",
     ("bottle", "exchange"): "_hy1.csv",
@@ -37,8 +57,18 @@ file_exts = {
     ("summary", "woce"): "su.txt",
 }
 
-get_files = defaultdict(dict)
-get_files_hashes = defaultdict(dict)
+# file types that are already compressed, deflating these again just burns CPU
+already_compressed = (".zip", ".nc", ".pdf")
+
+
+@dataclass(slots=True)
+class DLEntry:
+    """One file to fetch and bundle into its datatype archive."""
+
+    fhash: str
+    uri: str
+    fname: str
+    dtkey: tuple[str, str]
 
 
 def in_dataset(file):
@@ -58,18 +88,20 @@ download_cache = Path(dirs.user_cache_dir) / "downloads"
 
 
 def make_cruise_info(cruise) -> tuple[str, dict]:
-    chisci = list(
-        filter(lambda x: x["role"] == "Chief Scientist", cruise["participants"])
-    )
-    cochisci = list(
-        filter(lambda x: x["role"] == "Co-Chief Scientist", cruise["participants"])
-    )
+    # one pass over participants, this runs once per cruise in the hot loop
+    chisci = []
+    cochisci = []
+    for participant in cruise["participants"]:
+        if participant["role"] == "Chief Scientist":
+            chisci.append(participant)
+        elif participant["role"] == "Co-Chief Scientist":
+            cochisci.append(participant)
 
     woce_lines = ", ".join(cruise["collections"]["woce_lines"])
     oceans = ", ".join(cruise["collections"]["oceans"])
     programs = ", ".join(cruise["collections"]["programs"])
     groups = ", ".join(cruise["collections"]["groups"])
-    history_items = list(sorted(cruise["notes"], key=lambda x: x["date"]))
+    history_items = sorted(cruise["notes"], key=itemgetter("date"))
 
     history_block = []
     for note in history_items:
@@ -112,169 +144,394 @@ History
     return cruise_text, cruise_info
 
 
-async def get_and_write_to_temp(session, path: Path, uri, fhash, progress, total):
+class HashingWriter:
+    """Write only file wrapper that sha256s bytes as they pass through.
+
+    Deliberately not seekable so ZipFile streams entries with data
+    descriptors instead of seeking back to patch local headers, which would
+    invalidate a linear hash. The manifest entry for the archive then comes
+    for free when the archive is closed.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+    def tell(self):
+        return self.size
+
+    def seekable(self):
+        return False
+
+
+async def get_and_write_to_temp(
+    session,
+    path: Path,
+    uri,
+    fhash,
+    progress,
+    total,
+    verify_cache=False,
+    hash_pool=None,
+    verbose=False,
+):
     if path.exists():
-        with path.open("rb") as f:
-            existing_hash = file_digest(f, "sha256").hexdigest()
+        # the cache file is named for its sha256, so a non-empty file is
+        # correct by construction and does not need re-hashing every run
+        if path.stat().st_size > 0:
+            if not verify_cache:
+                progress.update(total, advance=1)
+                return
+            # mmap lets openssl chew through the whole file without a
+            # python side chunking loop
+            with path.open("rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    existing_hash = hashlib.sha256(mm).hexdigest()
             if existing_hash == fhash:
-                print(f"Already Loaded: {uri}")
                 progress.update(total, advance=1)
                 return
         path.unlink()
 
-    async with session.get(uri) as resp:
-        print(f"Downloading: {uri}")
-        with path.open("wb") as f:
-            f.write(await resp.read())
-
-    with path.open("rb") as f:
-        existing_hash = file_digest(f, "sha256").hexdigest()
-        if existing_hash != fhash:
+    # stream to a temp name and only rename onto the trusted sha256 name
+    # once the hash checks out, a corrupt or interrupted download must never
+    # be left where the trust-the-name skips would believe it forever
+    tmp_path = path.with_suffix(".part")
+    try:
+        async with session.get(uri) as resp:
+            if verbose:
+                # an unconditional print per download forces a bar re-render
+                # and measurable event loop latency under high concurrency
+                progress.console.log(f"Downloading: {uri}")
+            # hash while writing so the body is never held in memory and the
+            # file does not need a second read-back pass to verify
+            sha256 = hashlib.sha256()
+            loop = asyncio.get_running_loop()
+            # aiofiles keeps the disk writes off the event loop thread, so a
+            # burst of finishing downloads does not stall the other sockets
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in resp.content.iter_chunked(1 << 20):
+                    if hash_pool is not None:
+                        # hashlib drops the GIL for buffers this big, so the
+                        # SHA rounds run on another core while the loop keeps
+                        # feeding the other sockets
+                        await loop.run_in_executor(hash_pool, sha256.update, chunk)
+                    else:
+                        sha256.update(chunk)
+                    await f.write(chunk)
+
+        if sha256.hexdigest() != fhash:
             raise Exception("bad download")
+    except BaseException:
+        # also covers cancellation so a truncated body is not left behind
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    tmp_path.replace(path)
 
     progress.update(total, advance=1)
 
 
-def write_manifest_line(snapshot: Path, line):
-    with (snapshot / "_manifest.csv").open("+a") as manifest:
-        manifest.write(f"{line}\n")
+def build_archive(dtkey, files, hashes, cache_dir, snapshot_dir, level):
+    data_type, data_format = dtkey
+    fname = f"{data_type}_{data_format}.zip"
+    path = snapshot_dir / fname
+
+    with path.open("wb") as f:
+        writer = HashingWriter(f)
+        with ZipFile(writer, "w", compression=ZIP_DEFLATED, compresslevel=level) as zf:
+            for name in files:
+                ospath = cache_dir / hashes[name]
+                compress_type = None
+                if name.endswith(already_compressed):
+                    compress_type = ZIP_STORED
+                zf.write(ospath, name, compress_type=compress_type)
+
+    return fname, writer.size, writer.sha256.hexdigest()
 
 
-def write_manitfest_file(snapshot, path, fname):
-    with open(path, "rb") as f:
-        size = path.stat().st_size
-        file_hash = file_digest(f, "sha256").hexdigest()
-        write_manifest_line(snapshot, f"{fname},{size},{file_hash}")
+def write_manifest_line(manifest, line):
+    manifest.write(f"{line}\n")
 
 
-async def main():
-    async with aiohttp.ClientSession(CCHDO_API_BASE) as session:
+async def main(connection_limit=20, zip_level=4, verify_cache=False, verbose=False):
+    zip_level = min(zip_level, MAX_ZIP_LEVEL)
+    # Limit how many parallel requests are going, every request this program
+    # makes goes to cchdo.ucsd.edu so the per host cap is the effective
+    # concurrency and must follow the flag rather than a hardcoded number
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        limit_per_host=connection_limit,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+    )
+    async with aiohttp.ClientSession(CCHDO_API_BASE, connector=connector) as session:
+        # the cruise and file inventories are large deeply nested documents,
+        # orjson decodes them several times faster than the stdlib json
         async with session.get("/api/v1/cruise/all") as resp:
-            crusies = await resp.json()
+            crusies = await resp.json(loads=orjson.loads)
         async with session.get("/api/v1/file/all") as resp:
-            files = await resp.json()
+            files = await resp.json(loads=orjson.loads)
+
+        await snapshot_files(session, crusies, files, zip_level, verify_cache, verbose)
 
+
+async def snapshot_files(session, crusies, files, zip_level, verify_cache, verbose):
     file_by_id = {file["id"]: file for file in filter(in_dataset, files)}
 
     cruise_infos = []
     basins = Counter()
     programs = Counter()
+    # everything to download, one flat list instead of parallel dict-of-dict
+    # structures keyed twice, grouped by dtkey once collection is done
+    dl_entries: list[DLEntry] = []
+    # how many times a (file type, expocode) name has been handed out, so
+    # duplicate names dedup in O(1) instead of re-probing the dict, plus the
+    # names actually assigned per file type because distinct expocodes can
+    # produce the same name once suffixed ("X" with two files vs "X/2")
+    dedup_counts = defaultdict(int)
+    assigned_names = defaultdict(set)
 
     snapshot.mkdir(exist_ok=True)
 
-    write_manifest_line(snapshot, "file,size,sha256")
-
-    with ZipFile(
-        snapshot / "cruise_history.zip", "w", compression=ZIP_DEFLATED, compresslevel=9
-    ) as zf:
-        for cruise in crusies:
-            expocode = cruise["expocode"]
-            cruise_text, cruise_info = make_cruise_info(cruise)
-            cruise_infos.append(cruise_info)
-            zf.writestr(f"{expocode}_info.txt", cruise_text)
-            basins.update(cruise_info["collections"]["oceans"])
-            programs.update(cruise_info["collections"]["programs"])
-            for file_id in cruise["files"]:
-                try:
-                    file = file_by_id[file_id]
-                except KeyError:
-                    continue
-
-                file_key = (file["data_type"], file["data_format"])
-                if file_key not in file_exts:
-                    continue
-
-                fname = f"{expocode.replace('/', '_')}{file_exts[file_key]}"
-
-                count = 2
-                while fname in get_files[file_key]:
-                    fname = f"{expocode.replace('/', '_')}_{count}{file_exts[file_key]}"
-                    count += 1
-
-                get_files[file_key][
-                    fname
-                ] = f"https://cchdo.ucsd.edu{file['file_path']}"
-
-                get_files_hashes[file_key][fname] = file["file_hash"]
-
-    write_manitfest_file(
-        snapshot, snapshot / "cruise_history.zip", "cruise_history.zip"
-    )
-
-    ## TODO make this a flag feaature
-
-    # with open(snapshot / "programs.csv", "w", newline="") as cs:
-    #    columns = ("count", "program")
-    #    writer = csv.DictWriter(cs, columns, extrasaction="ignore")
-    #    writer.writeheader()
-    #    for count, program in programs.most_common():
-    #        writer.writerow({"count": count, "program": program})
-
-    # with open(snapshot / "basins.csv", "w", newline="") as cs:
-    #    columns = ("count", "basins")
-    #    writer = csv.DictWriter(cs, columns, extrasaction="ignore")
-    #    writer.writeheader()
-    #    for count, ocean in basins.most_common():
-    #        writer.writerow({"count": count, "basins": ocean})
-
-    with open(snapshot / "cruise_index.csv", "w", newline="") as cs:
-        columns = (
-            "expocode",
-            "startDate",
-            "endDate",
-            "ship",
-            "country",
-            "woce_lines",
-            "programs",
-            "oceans",
-            "groups",
+    # one manifest handle for the life of the run instead of reopening the
+    # file in append mode for every line
+    with (snapshot / "_manifest.csv").open("w") as manifest:
+        write_manifest_line(manifest, "file,size,sha256")
+
+        with (snapshot / "cruise_history.zip").open("wb") as f:
+            history_writer = HashingWriter(f)
+            with ZipFile(
+                history_writer,
+                "w",
+                compression=ZIP_DEFLATED,
+                compresslevel=zip_level,
+            ) as zf:
+                # writestr with a bare name stats the clock and rebuilds a
+                # ZipInfo per entry, prepare one with the run timestamp and
+                # pre-encoded text instead
+                info_date = now.timetuple()[:6]
+                for cruise in crusies:
+                    expocode = cruise["expocode"]
+                    cruise_text, cruise_info = make_cruise_info(cruise)
+                    cruise_infos.append(cruise_info)
+                    zinfo = ZipInfo(f"{expocode}_info.txt", date_time=info_date)
+                    zinfo.compress_type = ZIP_DEFLATED
+                    zinfo.external_attr = 0o600 << 16
+                    # writestr only honors the ZipFile's compresslevel when
+                    # it builds the ZipInfo itself, a prepared one must be
+                    # given the level explicitly
+                    zf.writestr(
+                        zinfo, cruise_text.encode("utf-8"), compresslevel=zip_level
+                    )
+                    basins.update(cruise_info["collections"]["oceans"])
+                    programs.update(cruise_info["collections"]["programs"])
+                    for file_id in cruise["files"]:
+                        try:
+                            file = file_by_id[file_id]
+                        except KeyError:
+                            continue
+
+                        file_key = (file["data_type"], file["data_format"])
+                        if file_key not in file_exts:
+                            continue
+
+                        base = expocode.replace("/", "_")
+                        seen = dedup_counts[(file_key, base)]
+                        if seen:
+                            fname = f"{base}_{seen + 1}{file_exts[file_key]}"
+                        else:
+                            fname = f"{base}{file_exts[file_key]}"
+                        names = assigned_names[file_key]
+                        while fname in names:
+                            seen += 1
+                            fname = f"{base}_{seen + 1}{file_exts[file_key]}"
+                        dedup_counts[(file_key, base)] = seen + 1
+                        names.add(fname)
+
+                        dl_entries.append(
+                            DLEntry(
+                                fhash=file["file_hash"],
+                                uri=file["file_path"],
+                                fname=fname,
+                                dtkey=file_key,
+                            )
+                        )
+
+        write_manifest_line(
+            manifest,
+            f"cruise_history.zip,{history_writer.size},"
+            f"{history_writer.sha256.hexdigest()}",
         )
 
-        writer = csv.DictWriter(cs, columns, extrasaction="ignore")
-        writer.writeheader()
-        writer.writerows(sorted(cruise_infos, key=lambda x: x["expocode"]))
-    write_manitfest_file(snapshot, snapshot / "cruise_index.csv", "cruise_index.csv")
-
-    with Progress() as progress:
-        total = progress.add_task(
-            "[red]Dowloading Files...", total=sum(len(f) for f in get_files.values())
+        ## TODO make this a flag feaature
+
+        # with open(snapshot / "programs.csv", "w", newline="") as cs:
+        #    columns = ("count", "program")
+        #    writer = csv.DictWriter(cs, columns, extrasaction="ignore")
+        #    writer.writeheader()
+        #    for count, program in programs.most_common():
+        #        writer.writerow({"count": count, "program": program})
+
+        # with open(snapshot / "basins.csv", "w", newline="") as cs:
+        #    columns = ("count", "basins")
+        #    writer = csv.DictWriter(cs, columns, extrasaction="ignore")
+        #    writer.writeheader()
+        #    for count, ocean in basins.most_common():
+        #        writer.writerow({"count": count, "basins": ocean})
+
+        with open(snapshot / "cruise_index.csv", "w", newline="") as cs:
+            columns = (
+                "expocode",
+                "startDate",
+                "endDate",
+                "ship",
+                "country",
+                "woce_lines",
+                "programs",
+                "oceans",
+                "groups",
+            )
+
+            writer = csv.DictWriter(cs, columns, extrasaction="ignore")
+            writer.writeheader()
+            cruise_infos.sort(key=itemgetter("expocode"))
+            writer.writerows(cruise_infos)
+
+        index_path = snapshot / "cruise_index.csv"
+        with index_path.open("rb") as f:
+            index_hash = file_digest(f, "sha256").hexdigest()
+        write_manifest_line(
+            manifest, f"cruise_index.csv,{index_path.stat().st_size},{index_hash}"
         )
 
-        fetch_list = []
-        for dtkey, files in get_files.items():
-            for fname, uri in files.items():
-                fetch_list.append((get_files_hashes[dtkey][fname], uri))
-
-        download_cache.mkdir(parents=True, exist_ok=True)
-
-        async with aiohttp.ClientSession() as session:
-            aio_tasks = [
-                get_and_write_to_temp(
-                    session,
-                    (download_cache / fhash),
-                    uri,
-                    fhash,
-                    progress,
-                    total,
+        with Progress(refresh_per_second=4) as progress:
+            total = progress.add_task(
+                "[red]Dowloading Files...", total=len(dl_entries)
+            )
+
+            download_cache.mkdir(parents=True, exist_ok=True)
+
+            loop = asyncio.get_running_loop()
+
+            cached = 0
+
+            # each datatype's archive only needs its own files, so start
+            # zipping a datatype in the process pool as soon as its downloads
+            # finish rather than waiting for the entire fetch to drain, the
+            # thread pool keeps download hashing off the event loop
+            with (
+                ThreadPoolExecutor(max_workers=4) as hash_pool,
+                ProcessPoolExecutor(max_workers=os.cpu_count()) as pool,
+            ):
+
+                async def download_then_archive(dtkey, entries):
+                    nonlocal cached
+                    data_type, data_format = dtkey
+                    dt_task = progress.add_task(
+                        f"[cyan]{data_type} {data_format}", total=len(entries)
+                    )
+
+                    # a snapshot is mostly a delta over the previous one,
+                    # don't even queue a task for files already in the cache
+                    # (the cache name is the sha256, see get_and_write_to_temp)
+                    needed = []
+                    for entry in entries:
+                        path = download_cache / entry.fhash
+                        if (
+                            not verify_cache
+                            and path.exists()
+                            and path.stat().st_size > 0
+                        ):
+                            cached += 1
+                            progress.update(total, advance=1)
+                            progress.update(dt_task, advance=1)
+                            continue
+                        needed.append((path, entry))
+
+                    async def fetch_one(path, entry):
+                        await get_and_write_to_temp(
+                            session,
+                            path,
+                            entry.uri,
+                            entry.fhash,
+                            progress,
+                            total,
+                            verify_cache,
+                            hash_pool,
+                            verbose,
+                        )
+                        progress.update(dt_task, advance=1)
+
+                    await asyncio.gather(
+                        *(fetch_one(path, entry) for path, entry in needed)
+                    )
+                    return await loop.run_in_executor(
+                        pool,
+                        build_archive,
+                        dtkey,
+                        [entry.fname for entry in entries],
+                        {entry.fname: entry.fhash for entry in entries},
+                        download_cache,
+                        snapshot,
+                        zip_level,
+                    )
+
+                dl_entries.sort(key=attrgetter("dtkey"))
+                archives = [
+                    download_then_archive(dtkey, list(entries))
+                    for dtkey, entries in groupby(dl_entries, key=attrgetter("dtkey"))
+                ]
+                for archive in asyncio.as_completed(archives):
+                    fname, size, file_hash = await archive
+                    progress.console.log(f"Made {fname}")
+                    write_manifest_line(manifest, f"{fname},{size},{file_hash}")
+
+            if cached:
+                progress.console.log(
+                    f"Skipped {cached} unchanged files already in the cache"
                 )
-                for fhash, uri in fetch_list
-            ]
-            await asyncio.gather(*aio_tasks)
-
-        for (data_type, data_format), files in get_files.items():
-            fname = f"{data_type}_{data_format}.zip"
-            path = snapshot / fname
-            path.parents[0].mkdir(parents=True, exist_ok=True)
-            print(f"Making {fname}")
-
-            with ZipFile(path, "w", compression=ZIP_DEFLATED, compresslevel=9) as zf:
-                for name in files:
-                    fhash = get_files_hashes[(data_type, data_format)][name]
-                    ospath = download_cache / fhash
-                    zf.write(ospath, name)
-
-            write_manitfest_file(snapshot, path, fname)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Make a snapshot of the CCHDO archive")
+    parser.add_argument(
+        "--connection-limit",
+        type=int,
+        default=20,
+        help="how many parallel requests are allowed to cchdo.ucsd.edu",
+    )
+    parser.add_argument(
+        "--zip-level",
+        type=int,
+        default=4,
+        choices=range(0, 10),
+        help="DEFLATE effort for the snapshot zips, higher is slower",
+    )
+    parser.add_argument(
+        "--verify-cache",
+        action="store_true",
+        help="re-hash cached downloads instead of trusting their names",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="log every file as it downloads",
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        main(
+            connection_limit=args.connection_limit,
+            zip_level=args.zip_level,
+            verify_cache=args.verify_cache,
+            verbose=args.verbose,
+        )
+    )